@@ -0,0 +1,75 @@
+import os
+import time
+
+import click
+
+from ckanext.cataloginventory.plugin import CataloginventoryPlugin, get_catalog_package_id, get_local_ckan, \
+    write_catalog_file
+
+
+@click.group()
+def cataloginventory():
+    """
+    Dataset Catalog management commands
+    """
+
+
+@cataloginventory.command()
+@click.option('--profile', is_flag=True, help='Profile the rebuild and write a report and a .pstats file')
+@click.option('--output', default='catalog-rebuild', show_default=True,
+              help='Path prefix for the profile report and .pstats file')
+@click.option('--dry-run', 'dry_run_path', metavar='PATH',
+              help='Write the catalog records to a local file instead of the datastore')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), default='csv', show_default=True,
+              help='Format of the --dry-run file')
+def rebuild(profile, output, dry_run_path, file_format):
+    """
+    Rebuild the Dataset Catalog resource from all public datasets
+    """
+    if dry_run_path:
+        dry_run(dry_run_path, file_format, profile, output)
+        return
+
+    local_ckan = get_local_ckan()
+    catalog_pkg_dict = local_ckan.action.package_show(id=get_catalog_package_id())
+    plugin = CataloginventoryPlugin()
+    catalog_res_id = plugin.get_catalog_resource_id(catalog_pkg_dict)
+
+    # An existing catalog is refreshed in place so its resource id and rows stay available
+    if catalog_res_id:
+        func, args = plugin.rebuild_catalog_inventory, [catalog_res_id]
+    else:
+        func, args = plugin.create_catalog_inventory, [catalog_pkg_dict]
+
+    try:
+        if profile:
+            from ckanext.cataloginventory.profiling import profile_call
+            _, report_path = profile_call(func, args, output)
+            click.secho('Profile report written to {0}'.format(report_path), fg='green')
+        else:
+            func(*args)
+    except Exception as e:  # pylint: disable=W0703
+        click.secho('Rebuild failed, the Dataset Catalog may be partly refreshed: {0}'.format(e), fg='red', err=True)
+        raise click.Abort()
+
+    click.secho('Dataset Catalog rebuilt', fg='green')
+
+
+def dry_run(path, file_format, profile, output):
+    started = time.time()
+    if profile:
+        from ckanext.cataloginventory.profiling import profile_call
+        count, report_path = profile_call(write_catalog_file, [path, file_format], output)
+        click.secho('Profile report written to {0}'.format(report_path), fg='green')
+    else:
+        count = write_catalog_file(path, file_format)
+    elapsed = time.time() - started
+
+    click.secho('Wrote {0} records to {1}'.format(count, path), fg='green')
+    click.echo('Elapsed: {0:.2f}s, {1:.1f} records/s, {2:.1f} MiB{3}'.format(
+        elapsed, count / elapsed if elapsed else 0, os.path.getsize(path) / 1024.0 / 1024.0,
+        ' (measured under the profiler, run without --profile for real throughput)' if profile else ''))
+
+
+def get_commands():
+    return [cataloginventory]
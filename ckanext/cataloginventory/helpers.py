@@ -1,24 +1,43 @@
 import os
-import logging
 import simplejson as json
 
-log = logging.getLogger(__name__)
-
 
 def get_export_map_json(map_filename):  # pylint: disable=W0612
     """
     Reading json export map from file
     :param map_filename: str
     :return: obj
+    :raises ValueError: when map_filename does not exist
     """
 
     map_path = os.path.join(os.path.dirname(__file__), 'export_map', map_filename)
 
     if not os.path.isfile(map_path):
-        log.warning('Could not find %s ! Please create it. Use samples from same folder', map_path)
-        map_path = os.path.join(os.path.dirname(__file__), 'export_map', 'export.map.json')
+        raise ValueError('Could not find export map {0}'.format(map_path))
 
     with open(map_path, 'r') as export_map_json:
         json_export_map = json.load(export_map_json)
 
     return json_export_map
+
+
+def validate_export_map(json_export_map):
+    """
+    Check that the export map can build catalog records
+    :param json_export_map: obj
+    :raises ValueError: when a required key is missing
+    """
+    if not isinstance(json_export_map, dict):
+        raise ValueError('Export map must be a JSON object')
+
+    for key in ('dataset_fields_map', 'ordered_fields'):
+        if not isinstance(json_export_map.get(key), list):
+            raise ValueError('Export map is missing the "{0}" list'.format(key))
+
+    for field_map in json_export_map['dataset_fields_map']:
+        if 'field_name' not in field_map or 'label' not in field_map:
+            raise ValueError('Export map field {0} needs a "field_name" and a "label"'.format(field_map))
+
+    ordered_ids = [field.get('id') for field in json_export_map['ordered_fields']]
+    if 'Dataset ID' not in ordered_ids:
+        raise ValueError('Export map ordered_fields must contain the "Dataset ID" primary key')
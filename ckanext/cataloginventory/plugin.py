@@ -1,34 +1,124 @@
+import csv
+import io
 import logging
+import time
 from datetime import datetime
 
-import ckanapi
+import simplejson as json
+
 import ckan.model as model   # pylint: disable=R0402
 import ckan.plugins as p
 
 from ckan.common import config
-from ckanext.cataloginventory.helpers import get_export_map_json
+from ckanext.cataloginventory.helpers import get_export_map_json, validate_export_map
 
 
 log = logging.getLogger(__name__)
 
 
-# Get Dataset Catalog package_id and resource description from ini file
-CATALOG_PACKAGE_ID = config.get('ckanext.cataloginventory.package_id', 'dataset-catalog')
-CATALOG_RESOURCE_DESCRIPTION = config.get('ckanext.cataloginventory.resource_description', '')
-MAP_FILENAME = config.get('ckanext.cataloginventory.map_filename', 'export.map.json')
+# Dataset Catalog settings read from the ini file and their defaults
+CONFIG_DEFAULTS = {
+    'ckanext.cataloginventory.package_id': 'dataset-catalog',
+    'ckanext.cataloginventory.resource_description': '',
+    'ckanext.cataloginventory.map_filename': 'export.map.json',
+    'ckan.site_url': '',
+}
+BACKFILL_BATCH_SIZE = 500
+
+LABEL_CACHE_TTL = 300
+SCHEMA_RECHECK_INTERVAL = 60
+
+# Config values and the parsed export map, read on first use and reset by update_config
+_config_cache = {}
+_export_map_cache = {}
+
+# (resource id, expected field ids) pairs already known to match the catalog table
+_synced_schemas = set()
+
+# (resource id, expected field ids) pairs with a schema sync job enqueued by this process,
+# mapped to the ids of the columns still missing and when the table was last checked
+_pending_schemas = {}
+
+# Group and organization display names keyed by id, with the time each was read, for records built
+# from the model when pkg_dict has no titles; search results already carry them
+_label_cache = {}
+
+
+def get_config_option(key):
+    """
+    Read a config value once CKAN has loaded its config and reuse it afterwards
+    """
+    if key not in _config_cache:
+        _config_cache[key] = config.get(key, CONFIG_DEFAULTS[key])
+    return _config_cache[key]
+
+
+def get_catalog_package_id():
+    return get_config_option('ckanext.cataloginventory.package_id')
+
+
+def get_catalog_resource_description():
+    return get_config_option('ckanext.cataloginventory.resource_description')
+
+
+def get_export_map():
+    """
+    Get the validated export map set by ckanext.cataloginventory.map_filename
+    """
+    if 'map' not in _export_map_cache:
+        json_export_map = get_export_map_json(get_config_option('ckanext.cataloginventory.map_filename'))
+        validate_export_map(json_export_map)
+        _export_map_cache['map'] = json_export_map
+    return _export_map_cache['map']
+
+
+def get_local_ckan():
+    """
+    ckanapi is only imported by the code paths that write to the catalog
+    """
+    import ckanapi
+    return ckanapi.LocalCKAN()  # running as site user
+
+
+def get_group_label(group_id):
+    """
+    Look up a group or organization display name, reading it from the database
+    when it is missing from the cache or older than LABEL_CACHE_TTL
+    """
+    if not group_id:
+        return ''
+    cached = _label_cache.get(group_id)
+    if cached and time.time() - cached[1] <= LABEL_CACHE_TTL:
+        return cached[0]
+
+    group = model.Group.get(group_id)
+    if group and group.state == 'active':
+        set_group_label(group)
+        return _label_cache[group_id][0]
+    _label_cache.pop(group_id, None)
+    return ''
+
+
+def set_group_label(group):
+    """
+    Keep the label cache in step with group and organization changes
+    """
+    if group.state == 'active':
+        _label_cache[group.id] = (group.title or group.name, time.time())
+    else:
+        _label_cache.pop(group.id, None)
 
 
 def get_dataset_fields():
     """
     Get the dataset fields that will appear in the dataset catalog
-    Custom schemas fields can be set to appear in the dataset catalog by setting MAP_FILENAME
+    Custom schemas fields can be set to appear in the dataset catalog by setting ckanext.cataloginventory.map_filename
     """
     dataset_fields = {}
-    json_export_map = get_export_map_json(MAP_FILENAME)
-    if not json_export_map:
-        return None, None
+    json_export_map = get_export_map()
     schema_fields = json_export_map.get('dataset_fields_map')
-    ordered_fields = json_export_map.get('ordered_fields')
+    # Copied so callers can't alter the cached export map
+    ordered_fields = [dict(field) for field in json_export_map.get('ordered_fields')]
 
     for field_map in schema_fields:
         dataset_fields[field_map['field_name']] = field_map['label']
@@ -45,12 +135,16 @@ def get_record_data(pkg_dict, dataset_fields):
     Build record data that will be sent to datastore API
     """
     if not pkg_dict.get('metadata_created'):
-        local_ckan = ckanapi.LocalCKAN()  # running as site user
-        full_pkg_dict = local_ckan.action.package_show(id=pkg_dict.get('id'))
-        pkg_dict['metadata_created'] = full_pkg_dict['metadata_created']
-        pkg_dict['metadata_modified'] = full_pkg_dict['metadata_modified']
-        pkg_dict['groups'] = full_pkg_dict['groups']
-        pkg_dict['organization'] = full_pkg_dict['organization']
+        # Read only what the record needs instead of a full package_show,
+        # group and organization names come from the label cache
+        package = model.Package.get(pkg_dict.get('id'))
+        if not package:
+            raise p.toolkit.ObjectNotFound('Dataset not found')
+        pkg_dict['metadata_created'] = package.metadata_created.isoformat()
+        pkg_dict['metadata_modified'] = package.metadata_modified.isoformat()
+        pkg_dict['groups'] = [{'id': group.id} for group in package.get_groups('group')]
+        pkg_dict['owner_org'] = package.owner_org
+        pkg_dict['organization'] = {'id': package.owner_org} if package.owner_org else None
 
     record_data = {}
 
@@ -66,10 +160,11 @@ def get_record_data(pkg_dict, dataset_fields):
             elif key in ['group', 'topic']:
                 record_data[dataset_fields[key]] = get_package_groups(pkg_dict.get('groups', []))
             elif key in ['owner_org', 'organization'] and pkg_dict.get('organization'):
-                record_data[dataset_fields[key]] = pkg_dict.get('organization', {}).get('title', '')
+                organization = pkg_dict.get('organization', {})
+                record_data[dataset_fields[key]] = organization.get('title') or get_group_label(organization.get('id'))
             elif key == 'full_url' and pkg_dict.get('name'):
                 record_data[dataset_fields[key]] = '{0}/dataset/{1}'.format(
-                    config.get('ckan.site_url'), pkg_dict.get('name', ''))
+                    get_config_option('ckan.site_url'), pkg_dict.get('name', ''))
             else:
                 record_data[dataset_fields[key]] = pkg_dict[key]
     return record_data
@@ -79,8 +174,8 @@ def get_package_groups(groups_dict):
     """
     Build out the group names comma separated string
     """
-    groups = [group.get('display_name') for group in groups_dict if group.get('display_name')]
-    return ','.join(groups)
+    groups = [group.get('display_name') or get_group_label(group.get('id')) for group in groups_dict]
+    return ','.join(group for group in groups if group)
 
 
 def get_package_tags(tags_dict):
@@ -91,13 +186,11 @@ def get_package_tags(tags_dict):
     return ','.join(tags)
 
 
-def get_all_packages():
+def iter_package_pages(n=500):
     """
-    Get all datasets when creating initial catalog resource
+    Yield public datasets one search page at a time
     """
-    n = 500
     page = 1
-    dataset_list = []
 
     while True:
         search_data_dict = {
@@ -109,18 +202,126 @@ def get_all_packages():
         }
 
         query = p.toolkit.get_action('package_search')({}, search_data_dict)
-        if len(query['results']):
-            dataset_list.extend(query['results'])
-            page += 1
-        else:
+        if not len(query['results']):
             break
+        yield query['results']
+        page += 1
+
 
+def get_all_packages():
+    """
+    Get all datasets when creating initial catalog resource
+    """
+    dataset_list = []
+    for results in iter_package_pages():
+        dataset_list.extend(results)
     return dataset_list
 
 
+def write_catalog_file(path, file_format='csv'):
+    """
+    Stream all public datasets through the export map into a local csv or ndjson file
+    without touching the datastore
+    :return: number of records written
+    """
+    dataset_fields, ordered_fields = get_dataset_fields()
+    field_ids = [field['id'] for field in ordered_fields]
+    # datastore_create would add these as extra columns with guessed types, so keep them in the file too
+    extra_labels = [label for label in dataset_fields.values() if label not in field_ids]
+    if extra_labels:
+        log.warning('Export map labels missing from ordered_fields: %s', ', '.join(extra_labels))
+    count = 0
+
+    with io.open(path, 'w', encoding='utf-8', newline='') as catalog_file:
+        if file_format == 'csv':
+            writer = csv.DictWriter(catalog_file, fieldnames=field_ids + extra_labels)
+            writer.writeheader()
+        for packages in iter_package_pages():
+            for package in packages:
+                if package.get('name') == get_catalog_package_id():
+                    continue
+                record_data = get_record_data(package, dataset_fields)
+                if file_format == 'csv':
+                    writer.writerow(record_data)
+                else:
+                    catalog_file.write(json.dumps(record_data, default=str) + u'\n')
+                count += 1
+
+    return count
+
+
+def get_catalog_fields(catalog_res_id):
+    """
+    Get the fields of the existing catalog datastore table, without the internal _id column
+    """
+    local_ckan = get_local_ckan()
+    result = local_ckan.action.datastore_search(resource_id=catalog_res_id, limit=0)
+    return [field for field in result['fields'] if field['id'] != '_id']
+
+
+def iter_catalog_rows(catalog_res_id, fields, n=500):
+    """
+    Yield rows of the catalog datastore table one page at a time
+    """
+    local_ckan = get_local_ckan()
+    offset = 0
+
+    while True:
+        result = local_ckan.action.datastore_search(
+            resource_id=catalog_res_id,
+            fields=fields,
+            sort='_id',
+            limit=n,
+            offset=offset
+        )
+        if not result['records']:
+            break
+        for record in result['records']:
+            yield record
+        offset += n
+
+
+def get_expected_fields(dataset_fields, ordered_fields):
+    """
+    Get the columns the catalog table should have: the ordered fields, then any mapped label
+    missing from them, which datastore_create adds as extra columns from the records
+    """
+    ordered_ids = [field['id'] for field in ordered_fields]
+    extra_fields = [{'id': label} for label in dataset_fields.values() if label not in ordered_ids]
+    return ordered_fields + extra_fields
+
+
+def get_schema_drift(expected_fields, catalog_fields):
+    """
+    Compare the expected catalog fields against the catalog table fields
+    Returns the expected fields missing from the table and the table field ids no longer expected
+    """
+    expected_ids = [field['id'] for field in expected_fields]
+    catalog_ids = [field['id'] for field in catalog_fields]
+    added_fields = [field for field in expected_fields if field['id'] not in catalog_ids]
+    dropped_ids = [field_id for field_id in catalog_ids if field_id not in expected_ids]
+    return added_fields, dropped_ids
+
+
+def drop_catalog_columns(catalog_res_id, field_ids):
+    """
+    Drop columns from the catalog datastore table in place
+    The datastore API can only append columns, so this goes through the datastore write engine
+    """
+    from ckanext.datastore.backend.postgres import get_write_engine, identifier
+
+    with get_write_engine().begin() as connection:
+        for field_id in field_ids:
+            connection.execute(u'ALTER TABLE {0} DROP COLUMN IF EXISTS {1}'.format(
+                identifier(catalog_res_id), identifier(field_id)))
+
+
 class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
     p.implements(p.IConfigurer)
     p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IGroupController, inherit=True)
+    p.implements(p.IOrganizationController, inherit=True)
+    p.implements(p.IClick)
 
     class _InventoryChecks:
         @classmethod
@@ -144,9 +345,9 @@ class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
         @classmethod
         def skip_dataset_if_it_is_catalog(cls, plugin_method):
             def wrapper(plugin_ins, context, pkg_dict):
-                if context.get('package') and context.get('package').name == CATALOG_PACKAGE_ID:
+                if context.get('package') and context.get('package').name == get_catalog_package_id():
                     return
-                if pkg_dict.get('name') == CATALOG_PACKAGE_ID:
+                if pkg_dict.get('name') == get_catalog_package_id():
                     return
                 plugin_method(plugin_ins, context, pkg_dict)
 
@@ -156,12 +357,12 @@ class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
         def skip_if_catalog_does_not_exist(cls, plugin_method):
             def wrapper(plugin_ins, context, pkg_dict):
                 try:
-                    local_ckan = ckanapi.LocalCKAN()  # running as site user
-                    catalog_pkg_dict = local_ckan.action.package_show(id=CATALOG_PACKAGE_ID)
+                    local_ckan = get_local_ckan()
+                    catalog_pkg_dict = local_ckan.action.package_show(id=get_catalog_package_id())
                     if catalog_pkg_dict.get('state') == 'deleted':
                         # user accidentally delete catalog
                         log.error('Catalog dataset is deleted, please create '
-                                  'dataset with package_id: ' + CATALOG_PACKAGE_ID)
+                                  'dataset with package_id: ' + get_catalog_package_id())
                         return
                 except p.toolkit.ObjectNotFound:
                     # If catalog does not exist logs should not be spammed for every change
@@ -186,6 +387,30 @@ class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
         p.toolkit.add_public_directory(config_, 'public')
         p.toolkit.add_resource('fanstatic', 'cataloginventory')
 
+        # Pick up the loaded config and fail fast on a broken export map
+        _config_cache.clear()
+        _export_map_cache.clear()
+        get_export_map()
+
+    # IClick
+    def get_commands(self):  # pylint: disable=R0201
+        from ckanext.cataloginventory.cli import get_commands
+        return get_commands()
+
+    # IGroupController, IOrganizationController
+    # IPackageController shares these hook names, so package entities are ignored
+    def create(self, entity):  # pylint: disable=R0201
+        if isinstance(entity, model.Group):
+            set_group_label(entity)
+
+    def edit(self, entity):  # pylint: disable=R0201
+        if isinstance(entity, model.Group):
+            set_group_label(entity)
+
+    def delete(self, entity):  # pylint: disable=R0201
+        if isinstance(entity, model.Group):
+            _label_cache.pop(entity.id, None)
+
     @_InventoryChecks.skip_dataset_if_it_is_not_active
     @_InventoryChecks.skip_dataset_if_it_is_private
     @_InventoryChecks.skip_dataset_if_it_is_catalog
@@ -214,18 +439,21 @@ class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
     # Try to upsert dataset metadata
     # Resource with dataset catalog will be create if it doesn't exist
     def upsert_catalog_inventory(self, pkg_dict):
-        local_ckan = ckanapi.LocalCKAN()  # running as site user
-        catalog_pkg_dict = local_ckan.action.package_show(id=CATALOG_PACKAGE_ID)
+        local_ckan = get_local_ckan()
+        catalog_pkg_dict = local_ckan.action.package_show(id=get_catalog_package_id())
 
         catalog_res_id = self.get_catalog_resource_id(catalog_pkg_dict)
         if not catalog_res_id:
             p.toolkit.enqueue_job(self.create_catalog_inventory, [catalog_pkg_dict])
             return
 
-        dataset_fields, _ = get_dataset_fields()
-
+        dataset_fields, ordered_fields = get_dataset_fields()
         record_data = get_record_data(pkg_dict, dataset_fields)
 
+        # Columns the table doesn't have yet are added and backfilled by the schema sync job
+        for field_id in self.check_catalog_schema(catalog_res_id, dataset_fields, ordered_fields):
+            record_data.pop(field_id, None)
+
         local_ckan.action.datastore_upsert(
             resource_id=catalog_res_id,
             records=[record_data]
@@ -235,20 +463,20 @@ class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
 
     # Create a new resource for dataset metadata
     def create_catalog_inventory(self, catalog_pkg_dict):
-        local_ckan = ckanapi.LocalCKAN()  # running as site user
+        local_ckan = get_local_ckan()
         dataset_fields, ordered_fields = get_dataset_fields()
         all_packages = get_all_packages()
 
         records = []
         for package in all_packages:
-            if package.get('name') != CATALOG_PACKAGE_ID:
+            if package.get('name') != get_catalog_package_id():
                 record_data = get_record_data(package, dataset_fields)
                 records.append(record_data)
 
         resource_dict = {
             'package_id': catalog_pkg_dict['name'],
             'name': 'Dataset Catalog',
-            'description': CATALOG_RESOURCE_DESCRIPTION,
+            'description': get_catalog_resource_description(),
             'resource_type': 'csv',
             'last_modified': datetime.utcnow()
         }
@@ -259,10 +487,136 @@ class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
             primary_key=['Dataset ID']
         )
 
+    # Compare the export map with the catalog table once per process and map version
+    # Returns the ids of mapped columns missing from the table, enqueuing at most one schema sync job for them
+    def check_catalog_schema(self, catalog_res_id, dataset_fields, ordered_fields):
+        expected_fields = get_expected_fields(dataset_fields, ordered_fields)
+        schema_key = (catalog_res_id, tuple(field['id'] for field in expected_fields))
+        if schema_key in _synced_schemas:
+            return []
+
+        pending = _pending_schemas.get(schema_key)
+        if pending and time.time() - pending[1] < SCHEMA_RECHECK_INTERVAL:
+            return pending[0]
+
+        added_fields, dropped_ids = get_schema_drift(expected_fields, get_catalog_fields(catalog_res_id))
+        if not added_fields and not dropped_ids:
+            _pending_schemas.pop(schema_key, None)
+            _synced_schemas.add(schema_key)
+            return []
+
+        added_ids = [field['id'] for field in added_fields]
+        if not pending:
+            p.toolkit.enqueue_job(self.sync_catalog_schema, [catalog_res_id])
+        _pending_schemas[schema_key] = (added_ids, time.time())
+        return added_ids
+
+    # Refresh every row of an existing catalog in place so its resource id stays the same
+    # Rows are upserted one search page at a time, then rows of datasets that are no longer public are removed
+    def rebuild_catalog_inventory(self, catalog_res_id):
+        local_ckan = get_local_ckan()
+        rebuild_started = datetime.utcnow().isoformat()
+        self.sync_catalog_schema(catalog_res_id, backfill=False)
+        dataset_fields, _ = get_dataset_fields()
+
+        dataset_ids = set()
+        for packages in iter_package_pages(BACKFILL_BATCH_SIZE):
+            records = [
+                get_record_data(package, dataset_fields)
+                for package in packages
+                if package.get('name') != get_catalog_package_id()
+            ]
+            if records:
+                local_ckan.action.datastore_upsert(
+                    resource_id=catalog_res_id,
+                    records=records,
+                    method='upsert'
+                )
+                dataset_ids.update(record['Dataset ID'] for record in records)
+
+        # Rows the package hooks wrote after the rebuild started are kept
+        stale_ids = [
+            row['Dataset ID'] for row in iter_catalog_rows(catalog_res_id, ['Dataset ID', 'Last Updated'])
+            if row['Dataset ID'] not in dataset_ids and (row['Last Updated'] or '') < rebuild_started
+        ]
+        for start in range(0, len(stale_ids), BACKFILL_BATCH_SIZE):
+            local_ckan.action.datastore_delete(
+                resource_id=catalog_res_id,
+                filters={'Dataset ID': stale_ids[start:start + BACKFILL_BATCH_SIZE]}
+            )
+
+        self.update_last_modified_dates(catalog_res_id)
+
+    # Add or drop catalog columns in place when the export map no longer matches the table
+    # New columns are backfilled instead of rebuilding the whole catalog
+    def sync_catalog_schema(self, catalog_res_id, backfill=True):
+        dataset_fields, ordered_fields = get_dataset_fields()
+        catalog_fields = get_catalog_fields(catalog_res_id)
+        added_fields, dropped_ids = get_schema_drift(get_expected_fields(dataset_fields, ordered_fields),
+                                                     catalog_fields)
+
+        if 'Dataset ID' in dropped_ids:
+            log.error('Export map no longer contains the "Dataset ID" primary key, '
+                      'the catalog resource needs to be recreated')
+            return
+
+        if dropped_ids:
+            log.info('Dropping catalog columns: %s', ', '.join(dropped_ids))
+            drop_catalog_columns(catalog_res_id, dropped_ids)
+            catalog_fields = [field for field in catalog_fields if field['id'] not in dropped_ids]
+
+        if added_fields:
+            log.info('Adding catalog columns: %s', ', '.join(field['id'] for field in added_fields))
+            local_ckan = get_local_ckan()
+            # Existing fields must be supplied first and in their current order,
+            # the datastore can't guess the type of a new column without records
+            local_ckan.action.datastore_create(
+                resource_id=catalog_res_id,
+                fields=catalog_fields + [dict(field, type=field.get('type', 'text')) for field in added_fields]
+            )
+            if backfill:
+                self.backfill_catalog_columns(catalog_res_id, [field['id'] for field in added_fields])
+
+    # Fill catalog columns for every dataset already in the catalog, one search page per update batch
+    def backfill_catalog_columns(self, catalog_res_id, field_ids):
+        local_ckan = get_local_ckan()
+        dataset_fields, _ = get_dataset_fields()
+        backfill_fields = dict(
+            (key, label) for key, label in dataset_fields.items()
+            if label in field_ids or key == 'name'
+        )
+
+        for packages in iter_package_pages(BACKFILL_BATCH_SIZE):
+            records = [
+                get_record_data(package, backfill_fields)
+                for package in packages
+                if package.get('name') != get_catalog_package_id()
+            ]
+            # Only update rows that exist, datasets missing from the catalog are
+            # left to the package hooks rather than inserted as partial rows
+            dataset_ids = [record['Dataset ID'] for record in records]
+            if dataset_ids:
+                existing = local_ckan.action.datastore_search(
+                    resource_id=catalog_res_id,
+                    filters={'Dataset ID': dataset_ids},
+                    fields=['Dataset ID'],
+                    limit=len(dataset_ids)
+                )
+                existing_ids = set(record['Dataset ID'] for record in existing['records'])
+                records = [record for record in records if record['Dataset ID'] in existing_ids]
+            if records:
+                local_ckan.action.datastore_upsert(
+                    resource_id=catalog_res_id,
+                    records=records,
+                    method='update'
+                )
+
+        self.update_last_modified_dates(catalog_res_id)
+
     # Delete the dataset record from the resource when it's deleted or made private
     def delete_catalog_inventory_record(self, pkg_dict):
-        local_ckan = ckanapi.LocalCKAN()  # running as site user
-        catalog_pkg_dict = local_ckan.action.package_show(id=CATALOG_PACKAGE_ID)
+        local_ckan = get_local_ckan()
+        catalog_pkg_dict = local_ckan.action.package_show(id=get_catalog_package_id())
 
         catalog_res_id = self.get_catalog_resource_id(catalog_pkg_dict)
         if not catalog_res_id:
@@ -290,7 +644,7 @@ class CataloginventoryPlugin(p.SingletonPlugin):  # pylint: disable=W0612
     @staticmethod
     def update_last_modified_dates(catalog_res_id):
         # Update last modified dates
-        package = model.Package.get(CATALOG_PACKAGE_ID)
+        package = model.Package.get(get_catalog_package_id())
         resource = model.Resource.get(catalog_res_id)
         if package and resource:
             package.metadata_modified = datetime.utcnow()
@@ -0,0 +1,72 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+
+log = logging.getLogger(__name__)
+
+
+# Rebuild stages reported from the profile: (stage, file name, function names)
+REBUILD_STAGES = [
+    ('Search paging', 'plugin.py', ('iter_package_pages',)),
+    ('Record mapping', 'plugin.py', ('get_record_data',)),
+    ('Datastore writes', 'action.py', ('datastore_create', 'datastore_upsert', 'datastore_delete')),
+]
+
+
+def get_stage_times(stats):
+    """
+    Sum the cumulative time of the functions behind each rebuild stage
+    :param stats: pstats.Stats
+    :return: list of (stage, calls, seconds)
+    """
+    stage_times = []
+    for stage, filename, function_names in REBUILD_STAGES:
+        calls = 0
+        seconds = 0.0
+        for (path, _, name), (_, ncalls, _, cumtime, _) in stats.stats.items():
+            if name in function_names and os.path.basename(path) == filename:
+                calls += ncalls
+                seconds += cumtime
+        stage_times.append((stage, calls, seconds))
+    return stage_times
+
+
+def profile_call(func, args, output_prefix):
+    """
+    Run func under cProfile and tracemalloc, then write <output_prefix>.pstats
+    and a plain text report to <output_prefix>.txt
+    :return: func result and report path
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    started = time.time()
+    try:
+        result = profiler.runcall(func, *args)
+    finally:
+        elapsed = time.time() - started
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    stats_path = output_prefix + '.pstats'
+    report_path = output_prefix + '.txt'
+    profiler.dump_stats(stats_path)
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stream.write(u'Total time: {0:.2f}s\n'.format(elapsed))
+    stream.write(u'Peak traced memory: {0:.1f} MiB\n\n'.format(peak_memory / 1024.0 / 1024.0))
+    for stage, calls, seconds in get_stage_times(stats):
+        stream.write(u'{0:<20} {1:>10.2f}s {2:>10} calls\n'.format(stage, seconds, calls))
+    stream.write(u'\n')
+    stats.sort_stats('cumulative').print_stats(30)
+
+    with io.open(report_path, 'w', encoding='utf-8') as report:
+        report.write(stream.getvalue())
+
+    log.info('Profile written to %s and %s', report_path, stats_path)
+    return result, report_path
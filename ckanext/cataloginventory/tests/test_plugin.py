@@ -1,15 +1,29 @@
 """Tests for plugin.py."""
+import json
+import os
+import time
 import uuid
 from datetime import datetime
+from unittest import mock
 
+import pytest
+
+import ckan.model as model   # pylint: disable=R0402
 import ckan.plugins as p
+from ckan.common import config
 from ckan.lib import search
 from ckan.tests import helpers, factories
-from nose.tools import assert_false, assert_true, assert_not_equal, assert_in
+from nose.tools import assert_false, assert_true, assert_equal, assert_not_equal, assert_in, assert_raises
+from click.testing import CliRunner
 from testfixtures import LogCapture
 
-from ckanext.cataloginventory.plugin import CATALOG_PACKAGE_ID, CATALOG_RESOURCE_DESCRIPTION, get_record_data, \
-    get_all_packages, get_dataset_fields
+from ckanext.cataloginventory.cli import cataloginventory
+from ckanext.cataloginventory.profiling import profile_call
+from ckanext.cataloginventory.helpers import get_export_map_json, validate_export_map
+from ckanext.cataloginventory.plugin import get_catalog_package_id, get_catalog_resource_description, get_record_data, \
+    get_all_packages, get_dataset_fields, get_catalog_fields, write_catalog_file, get_schema_drift, get_package_groups, \
+    drop_catalog_columns, get_expected_fields, _pending_schemas, _synced_schemas, get_group_label, _label_cache, \
+    _config_cache, _export_map_cache, CataloginventoryPlugin
 
 
 class TestCatalogBase(object):
@@ -30,9 +44,9 @@ class TestCatalogBase(object):
         )
         # Create Dataset Catalog Witch
         factories.Dataset(
-            id=CATALOG_PACKAGE_ID,
-            name=CATALOG_PACKAGE_ID,
-            description=CATALOG_RESOURCE_DESCRIPTION,
+            id=get_catalog_package_id(),
+            name=get_catalog_package_id(),
+            description=get_catalog_resource_description(),
             user=cls.user,
             owner_org=cls.org['id']
         )
@@ -43,7 +57,7 @@ class TestCatalogBase(object):
             user=cls.user,
             owner_org=cls.org['id']
         )
-        cls.catalog_id = CATALOG_PACKAGE_ID
+        cls.catalog_id = get_catalog_package_id()
         cls.catalog_res_id = cls.create_catalog_inventory(cls.user['name'])
 
     @classmethod
@@ -68,13 +82,13 @@ class TestCatalogBase(object):
         dataset_fields, ordered_fields = get_dataset_fields()
         records = []
         for package in get_all_packages():
-            if package.get('name') != CATALOG_PACKAGE_ID:
+            if package.get('name') != get_catalog_package_id():
                 record_data = get_record_data(package, dataset_fields)
                 records.append(record_data)
         resource = {
-            'package_id': CATALOG_PACKAGE_ID,
+            'package_id': get_catalog_package_id(),
             'name': 'Dataset Catalog',
-            'description': CATALOG_RESOURCE_DESCRIPTION,
+            'description': get_catalog_resource_description(),
             'resource_type': 'csv',
             'last_modified': datetime.utcnow()
         }
@@ -138,7 +152,7 @@ class TestCatalogBase(object):
 #     def test_catalog_resource_does_not_exist(self):
 #
 #         # check that catalog resource doesnot exist
-#         catalog = helpers.call_action('package_show', id=CATALOG_PACKAGE_ID)
+#         catalog = helpers.call_action('package_show', id=get_catalog_package_id())
 #         assert len(catalog['resources']), 0
 #         # create new dataset
 #
@@ -147,7 +161,7 @@ class TestCatalogBase(object):
 #             name='den-dataset'
 #         )
 #         # check that resource was created
-#         catalog = helpers.call_action('package_show', id=CATALOG_PACKAGE_ID)
+#         catalog = helpers.call_action('package_show', id=get_catalog_package_id())
 #         pprint(catalog)
 #         assert len(catalog['resources']), 1
 #
@@ -165,7 +179,7 @@ class TestCatalogPackageDoesNotExist(TestCatalogBase):  # pylint: disable=W0612
         dataset_data = self.generate_dataset_data()
         with LogCapture() as logs:
             factories.Dataset(**dataset_data)
-            msg = 'Catalog dataset is deleted, please create dataset with package_id: ' + CATALOG_PACKAGE_ID
+            msg = 'Catalog dataset is deleted, please create dataset with package_id: ' + get_catalog_package_id()
             assert_in(msg, [log.msg for log in logs.records])
 
     def test_after_delete(self):
@@ -173,7 +187,7 @@ class TestCatalogPackageDoesNotExist(TestCatalogBase):  # pylint: disable=W0612
         factories.Dataset(**dataset_data)
         with LogCapture() as logs:
             helpers.call_action('package_delete', id=dataset_data['id'])
-            msg = 'Catalog dataset is deleted, please create dataset with package_id: ' + CATALOG_PACKAGE_ID
+            msg = 'Catalog dataset is deleted, please create dataset with package_id: ' + get_catalog_package_id()
             assert_in(msg, [log.msg for log in logs.records])
 
     def test_after_update(self):
@@ -181,7 +195,7 @@ class TestCatalogPackageDoesNotExist(TestCatalogBase):  # pylint: disable=W0612
         factories.Dataset(**dataset_data)
         with LogCapture() as logs:
             self.patch_dataset(dataset_data)
-            msg = 'Catalog dataset is deleted, please create dataset with package_id: ' + CATALOG_PACKAGE_ID
+            msg = 'Catalog dataset is deleted, please create dataset with package_id: ' + get_catalog_package_id()
             assert_in(msg, [log.msg for log in logs.records])
 
 
@@ -322,3 +336,310 @@ class TestPackageWhichNotDatasetType(TestCatalogBase):  # pylint: disable=W0612
         # Dataset should not exist in catalog
         assert_false(self.catalog_last_modified_changed())
         assert_false(self.catalog_resource_last_modified_changed())
+
+
+def get_drifted_dataset_fields():
+    """
+    Export map with the Tags column unmapped and a new label that is mapped but not in ordered_fields
+    """
+    dataset_fields, ordered_fields = get_dataset_fields()
+    del dataset_fields['tag_string']
+    dataset_fields['state'] = 'Extra Column'
+    ordered_fields = [field for field in ordered_fields if field['id'] != 'Tags']
+    return dataset_fields, ordered_fields
+
+
+def get_unordered_dataset_fields():
+    """
+    Export map with Tags still mapped but removed from ordered_fields
+    """
+    dataset_fields, ordered_fields = get_dataset_fields()
+    ordered_fields = [field for field in ordered_fields if field['id'] != 'Tags']
+    return dataset_fields, ordered_fields
+
+
+class TestCatalogSchemaDrift(TestCatalogBase):  # pylint: disable=W0612
+
+    def teardown(self):
+        _pending_schemas.clear()
+        _synced_schemas.clear()
+
+    def test_get_schema_drift(self):
+        ordered_fields = [{'id': 'Title'}, {'id': 'Dataset ID'}, {'id': 'Owner'}]
+        catalog_fields = [{'id': 'Title', 'type': 'text'}, {'id': 'Dataset ID', 'type': 'text'},
+                          {'id': 'Tags', 'type': 'text'}]
+        added_fields, dropped_ids = get_schema_drift(ordered_fields, catalog_fields)
+        assert_equal(added_fields, [{'id': 'Owner'}])
+        assert_equal(dropped_ids, ['Tags'])
+
+    def test_get_expected_fields(self):
+        dataset_fields = {'title': 'Title', 'name': 'Dataset ID', 'state': 'State'}
+        ordered_fields = [{'id': 'Dataset ID'}, {'id': 'Title'}]
+        expected_ids = [field['id'] for field in get_expected_fields(dataset_fields, ordered_fields)]
+        assert_equal(expected_ids, ['Dataset ID', 'Title', 'State'])
+
+    def test_upsert_with_schema_drift(self):
+        first_dataset = self.generate_dataset_data()
+        second_dataset = self.generate_dataset_data()
+        with mock.patch('ckanext.cataloginventory.plugin.get_dataset_fields', get_drifted_dataset_fields), \
+                mock.patch.object(p.toolkit, 'enqueue_job') as enqueue_job:
+            factories.Dataset(**first_dataset)
+            factories.Dataset(**second_dataset)
+
+        # Records are saved without the missing column and a single schema sync is left to a job
+        assert_true(self.catalog_resource_contain_record_about_dataset(first_dataset))
+        assert_true(self.catalog_resource_contain_record_about_dataset(second_dataset))
+        enqueue_job.assert_called_once_with(CataloginventoryPlugin().sync_catalog_schema, [self.catalog_res_id])
+
+    def test_sync_catalog_schema(self):
+        dataset_data = self.generate_dataset_data()
+        with mock.patch('ckanext.cataloginventory.plugin.get_dataset_fields', get_drifted_dataset_fields):
+            CataloginventoryPlugin().sync_catalog_schema(self.catalog_res_id)
+            catalog_ids = [field['id'] for field in get_catalog_fields(self.catalog_res_id)]
+            # Datasets saved after the sync get every mapped column
+            factories.Dataset(**dataset_data)
+
+        assert_in('Extra Column', catalog_ids)
+        assert_false('Tags' in catalog_ids)
+        # Existing records are kept and the new column is backfilled
+        assert_equal(self.get_dataset_record_from_catalog(self.test_dataset)['Extra Column'], 'active')
+        assert_equal(self.get_dataset_record_from_catalog(dataset_data)['Extra Column'], 'active')
+
+    def test_mapped_column_is_kept(self):
+        dataset_data = self.generate_dataset_data()
+        with mock.patch('ckanext.cataloginventory.plugin.get_dataset_fields', get_unordered_dataset_fields):
+            CataloginventoryPlugin().sync_catalog_schema(self.catalog_res_id)
+            catalog_ids = [field['id'] for field in get_catalog_fields(self.catalog_res_id)]
+            factories.Dataset(**dataset_data)
+
+        assert_in('Tags', catalog_ids)
+        assert_true(self.catalog_resource_contain_record_about_dataset(dataset_data))
+
+
+class TestCatalogBackfill(TestCatalogBase):  # pylint: disable=W0612
+
+    def test_backfill_catalog_columns(self):
+        missing_dataset = factories.Dataset(**self.generate_dataset_data())
+        helpers.call_action('datastore_delete', resource_id=self.catalog_res_id,
+                            filters={'Dataset ID': missing_dataset['name']})
+        # Recreate the Title column empty at the end of the table
+        drop_catalog_columns(self.catalog_res_id, ['Title'])
+        helpers.call_action('datastore_create', resource_id=self.catalog_res_id,
+                            fields=get_catalog_fields(self.catalog_res_id) + [{'id': 'Title', 'type': 'text'}])
+
+        CataloginventoryPlugin().backfill_catalog_columns(self.catalog_res_id, ['Title'])
+
+        dataset_record = self.get_dataset_record_from_catalog(self.test_dataset)
+        assert_equal(dataset_record['Title'], self.test_dataset['title'])
+        # Datasets missing from the catalog are not inserted as partial rows
+        assert_false(self.catalog_resource_contain_record_about_dataset(missing_dataset))
+
+
+class TestGroupLabelCache(TestCatalogBase):  # pylint: disable=W0612
+
+    def teardown(self):
+        _label_cache.clear()
+
+    def get_model_record(self, dataset):
+        # Without metadata_created the record is built from the model and the label cache
+        dataset_fields, _ = get_dataset_fields()
+        return get_record_data({'id': dataset['id'], 'name': dataset['name']}, dataset_fields)
+
+    def test_organization_title_change(self):
+        assert_equal(self.get_model_record(self.test_dataset)['Organization'], self.org['title'])
+        helpers.call_action('organization_patch', context={'user': self.user['name']},
+                            id=self.org['id'], title='Renamed Organisation')
+        # The edit hook updated the cached label
+        assert_equal(self.get_model_record(self.test_dataset)['Organization'], 'Renamed Organisation')
+
+    def test_expired_label_is_refreshed(self):
+        _label_cache[self.org['id']] = ('Stale Organisation', 0)
+        assert_equal(get_group_label(self.org['id']), model.Group.get(self.org['id']).title)
+
+    def test_title_in_pkg_dict_wins_over_cache(self):
+        dataset_fields, _ = get_dataset_fields()
+        _label_cache[self.org['id']] = ('Stale Organisation', time.time())
+        pkg_dict = helpers.call_action('package_show', id=self.test_dataset['id'])
+        record_data = get_record_data(pkg_dict, dataset_fields)
+        assert_not_equal(record_data['Organization'], 'Stale Organisation')
+
+    def test_organization_created_in_another_process(self):
+        # Created without this process's hooks seeing it
+        with mock.patch.object(CataloginventoryPlugin, 'create'):
+            org = factories.Organization(
+                title='New Organisation',
+                users=[{'name': self.user['name'], 'capacity': 'admin'}]
+            )
+        dataset = factories.Dataset(owner_org=org['id'], user=self.user)
+        assert_equal(self.get_model_record(dataset)['Organization'], 'New Organisation')
+
+    def test_record_for_missing_dataset(self):
+        dataset_fields, _ = get_dataset_fields()
+        with assert_raises(p.toolkit.ObjectNotFound):
+            get_record_data({'id': 'missing-dataset'}, dataset_fields)
+
+    def test_group_label_fallback(self):
+        groups = [{'id': 'unknown-group', 'display_name': 'Unknown Group'}, {'id': 'no-name-group'}]
+        assert_equal(get_package_groups(groups), 'Unknown Group')
+
+
+class TestCatalogRebuildProfile(TestCatalogBase):  # pylint: disable=W0612
+
+    def test_profile_call(self, tmp_path):
+        output_prefix = str(tmp_path / 'catalog-rebuild')
+        _, report_path = profile_call(get_all_packages, [], output_prefix)
+
+        assert_true(os.path.isfile(output_prefix + '.pstats'))
+        with open(report_path) as report:
+            report_text = report.read()
+        assert_in('Peak traced memory', report_text)
+        assert_in('Search paging', report_text)
+
+
+class TestCatalogRebuildCommand(TestCatalogBase):  # pylint: disable=W0612
+
+    def get_catalog_resource_ids(self):
+        return [res['id'] for res in self.get_catalog()['resources'] if res['name'] == 'Dataset Catalog']
+
+    def get_catalog_dataset_ids(self, catalog_res_id):
+        return [record['Dataset ID'] for record in self.get_resource(catalog_res_id)['records']]
+
+    def insert_catalog_row(self, dataset_id, last_updated):
+        helpers.call_action('datastore_upsert', resource_id=self.catalog_res_id, method='insert',
+                            records=[{'Dataset ID': dataset_id, 'Last Updated': last_updated}])
+
+    def test_rebuild(self):
+        old_res_ids = self.get_catalog_resource_ids()
+        helpers.call_action('datastore_delete', resource_id=self.catalog_res_id,
+                            filters={'Dataset ID': self.test_dataset['name']})
+        self.insert_catalog_row('gone-dataset', '2000-01-01T00:00:00')
+        result = CliRunner().invoke(cataloginventory, ['rebuild'])
+
+        assert_equal(result.exit_code, 0, result.output)
+        # The catalog is refreshed in place
+        assert_equal(self.get_catalog_resource_ids(), old_res_ids)
+        dataset_ids = self.get_catalog_dataset_ids(self.catalog_res_id)
+        assert_in(self.test_dataset['name'], dataset_ids)
+        assert_false('gone-dataset' in dataset_ids)
+
+    def test_rebuild_keeps_rows_written_during_rebuild(self):
+        self.insert_catalog_row('new-dataset', '2999-01-01T00:00:00')
+        result = CliRunner().invoke(cataloginventory, ['rebuild'])
+
+        assert_equal(result.exit_code, 0, result.output)
+        assert_in('new-dataset', self.get_catalog_dataset_ids(self.catalog_res_id))
+
+    def test_rebuild_profile(self, tmp_path):
+        old_res_ids = self.get_catalog_resource_ids()
+        output_prefix = str(tmp_path / 'catalog-rebuild')
+        result = CliRunner().invoke(cataloginventory, ['rebuild', '--profile', '--output', output_prefix])
+
+        assert_equal(result.exit_code, 0, result.output)
+        assert_true(os.path.isfile(output_prefix + '.pstats'))
+        assert_true(os.path.isfile(output_prefix + '.txt'))
+        assert_equal(self.get_catalog_resource_ids(), old_res_ids)
+
+    def test_rebuild_failure_keeps_catalog(self):
+        old_res_ids = self.get_catalog_resource_ids()
+        with mock.patch.object(CataloginventoryPlugin, 'rebuild_catalog_inventory', side_effect=ValueError('boom')):
+            result = CliRunner().invoke(cataloginventory, ['rebuild'])
+
+        assert_not_equal(result.exit_code, 0)
+        assert_equal(self.get_catalog_resource_ids(), old_res_ids)
+
+    def test_rebuild_creates_missing_catalog(self):
+        for res_id in self.get_catalog_resource_ids():
+            helpers.call_action('resource_delete', id=res_id)
+        result = CliRunner().invoke(cataloginventory, ['rebuild'])
+
+        assert_equal(result.exit_code, 0, result.output)
+        new_res_ids = self.get_catalog_resource_ids()
+        assert_equal(len(new_res_ids), 1)
+        assert_in(self.test_dataset['name'], self.get_catalog_dataset_ids(new_res_ids[0]))
+
+
+class TestCatalogDryRun(TestCatalogBase):  # pylint: disable=W0612
+
+    def test_rebuild_dry_run(self, tmp_path):
+        path = str(tmp_path / 'catalog.csv')
+        result = CliRunner().invoke(cataloginventory, ['rebuild', '--dry-run', path])
+
+        assert_equal(result.exit_code, 0, result.output)
+        assert_in('records/s', result.output)
+        assert_true(os.path.isfile(path))
+        # Datastore is left untouched
+        assert_false(self.catalog_last_modified_changed())
+
+    def test_write_catalog_csv(self, tmp_path):
+        path = str(tmp_path / 'catalog.csv')
+        count = write_catalog_file(path, 'csv')
+
+        assert_equal(count, len([pkg for pkg in get_all_packages() if pkg.get('name') != get_catalog_package_id()]))
+        with open(path) as catalog_file:
+            header = catalog_file.readline()
+        assert_true(header.startswith('Title,Description,Dataset ID'))
+        # Datastore is left untouched
+        assert_false(self.catalog_last_modified_changed())
+
+    def test_write_catalog_ndjson(self, tmp_path):
+        path = str(tmp_path / 'catalog.ndjson')
+        count = write_catalog_file(path, 'ndjson')
+
+        with open(path) as catalog_file:
+            records = [json.loads(line) for line in catalog_file]
+        assert_equal(len(records), count)
+        assert_in(self.test_dataset['name'], [record['Dataset ID'] for record in records])
+
+    def test_labels_missing_from_ordered_fields(self, tmp_path):
+        dataset_fields, ordered_fields = get_dataset_fields()
+        dataset_fields['state'] = 'Extra Label'
+        path = str(tmp_path / 'catalog.csv')
+        with mock.patch('ckanext.cataloginventory.plugin.get_dataset_fields',
+                        return_value=(dataset_fields, ordered_fields)), LogCapture() as logs:
+            write_catalog_file(path, 'csv')
+
+        with open(path) as catalog_file:
+            header = catalog_file.readline()
+        assert_in('Extra Label', header)
+        assert_in('Export map labels missing from ordered_fields: %s', [log.msg for log in logs.records])
+
+
+class TestExportMapValidation(object):  # pylint: disable=W0612
+
+    def test_default_export_map_is_valid(self):
+        validate_export_map(get_export_map_json('export.map.json'))
+
+    def test_missing_export_map_file(self):
+        with assert_raises(ValueError):
+            get_export_map_json('missing.map.json')
+
+    def test_missing_ordered_fields(self):
+        with assert_raises(ValueError):
+            validate_export_map({'dataset_fields_map': []})
+
+    def test_missing_primary_key(self):
+        with assert_raises(ValueError):
+            validate_export_map({
+                'dataset_fields_map': [{'field_name': 'title', 'label': 'Title'}],
+                'ordered_fields': [{'id': 'Title'}]
+            })
+
+
+class TestLazyConfig(object):  # pylint: disable=W0612
+
+    def teardown(self):
+        # Let later tests read the test.ini settings again
+        _config_cache.clear()
+        _export_map_cache.clear()
+
+    @pytest.mark.ckan_config('ckanext.cataloginventory.package_id', 'other-catalog')
+    def test_update_config_picks_up_changed_setting(self, ckan_config):  # pylint: disable=W0613
+        get_catalog_package_id()
+        _config_cache['ckanext.cataloginventory.package_id'] = 'stale-catalog'
+        CataloginventoryPlugin().update_config(config)
+        assert_equal(get_catalog_package_id(), 'other-catalog')
+
+    @pytest.mark.ckan_config('ckanext.cataloginventory.map_filename', 'missing.map.json')
+    def test_missing_export_map_fails_fast(self, ckan_config):  # pylint: disable=W0613
+        with assert_raises(ValueError):
+            CataloginventoryPlugin().update_config(config)